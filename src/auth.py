@@ -19,4 +19,10 @@ async def main():
     await client.disconnect()
 
 if __name__ == "__main__":
+    # libuv-based event loop where available; the stdlib loop otherwise
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())
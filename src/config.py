@@ -1,6 +1,8 @@
 import os
+import re
+import sys
 import logging
-from typing import List, Optional
+from typing import List, Optional, Pattern
 from dataclasses import dataclass
 from dotenv import load_dotenv
 
@@ -8,13 +10,19 @@ load_dotenv()
 
 import yaml
 
+# libyaml C bindings when available, pure-Python loader otherwise
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Route:
     name: str
     source_id: int
@@ -26,27 +34,76 @@ class Config:
     API_HASH = os.getenv("API_HASH", "")
     BOT_TOKEN = os.getenv("BOT_TOKEN", "")
     DB_NAME = os.getenv("DB_NAME", "messages.db")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    # Max queued target-id updates written per transaction
+    DB_WRITE_BATCH = max(1, int(os.getenv("DB_WRITE_BATCH", "128")))
+    # Failed target-id writes are retried this many times before they are dropped
+    DB_WRITE_MAX_RETRIES = int(os.getenv("DB_WRITE_MAX_RETRIES", "3"))
+    # In-memory dedup/target-id cache: max entries and entry lifetime in seconds
+    DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "100000"))
+    DEDUP_CACHE_TTL = float(os.getenv("DEDUP_CACHE_TTL", "86400"))
     SESSION_NAME = "src/sessions/userbot"
     ROUTES_FILE = "routes.yml"
     POLLING_INTERVAL = float(os.getenv("POLLING_INTERVAL", "5"))
+    # Max messages fetched per source per poll cycle; the rest follow next cycle
+    POLL_BATCH_SIZE = int(os.getenv("POLL_BATCH_SIZE", "500"))
+    # Per-chat backlog before producers wait on the chat processor
+    CHAT_QUEUE_MAX = int(os.getenv("CHAT_QUEUE_MAX", "256"))
+    # Max queued messages a chat processor takes per wakeup
+    CHAT_DRAIN_BATCH = max(1, int(os.getenv("CHAT_DRAIN_BATCH", "32")))
+    # Seconds without messages before a chat's processor task exits
+    CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_TIMEOUT", "60"))
+    # Max chats with a live processor; the least recently active one is retired first
+    MAX_ACTIVE_CHATS = int(os.getenv("MAX_ACTIVE_CHATS", "256"))
+    DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+    # Media up to this many bytes is kept in memory instead of going through src/tmp/.
+    # Kept small: the bytes sit in the sender queues until sent, FloodWaits included.
+    MEDIA_IN_MEMORY_LIMIT = int(os.getenv("MEDIA_IN_MEMORY_LIMIT", str(5 * 1024 * 1024)))
+    SENDER_WORKERS = max(1, int(os.getenv("SENDER_WORKERS", "4")))
+    # Per-worker backlog before chat processors wait on the sender. Also caps the
+    # in-memory media held while a worker sleeps out FloodWaits.
+    SENDER_QUEUE_MAX = max(1, int(os.getenv("SENDER_QUEUE_MAX", "16")))
+    # FloodWaits slept out per send before the message is given up on
+    FLOOD_WAIT_MAX_RETRIES = int(os.getenv("FLOOD_WAIT_MAX_RETRIES", "5"))
+    # Quiet period after the last album part before the album is flushed
+    ALBUM_FLUSH_TIMEOUT = float(os.getenv("ALBUM_FLUSH_TIMEOUT", "2.0"))
     
-    BLACKLIST_WORDS = ["mirror", "миррор", "cismirror"]
+    BLACKLIST_WORDS = ("mirror", "миррор", "cismirror")
+    BLACKLIST_RE: Optional[Pattern[str]] = None
+
+    _routes: Optional[List[Route]] = None
 
-    ROUTES: List[Route] = []
+    @classmethod
+    def compile_filters(cls):
+        """Compiles BLACKLIST_WORDS into one case-insensitive regex, scanned once per message."""
+        cls.BLACKLIST_WORDS = tuple(dict.fromkeys(w.lower() for w in cls.BLACKLIST_WORDS if w))
+        if cls.BLACKLIST_WORDS:
+            pattern = "|".join(map(re.escape, cls.BLACKLIST_WORDS))
+            cls.BLACKLIST_RE = re.compile(pattern, re.IGNORECASE)
+        else:
+            cls.BLACKLIST_RE = None
+
+    @classmethod
+    def routes(cls) -> List[Route]:
+        """Routes from ROUTES_FILE, parsed on first access rather than at import."""
+        if cls._routes is None:
+            cls._routes = cls.load_routes()
+        return cls._routes
 
     @classmethod
-    def load_routes(cls):
+    def load_routes(cls) -> List[Route]:
+        routes: List[Route] = []
         if not os.path.exists(cls.ROUTES_FILE):
              logger.warning(f"{cls.ROUTES_FILE} not found!")
-             return
+             return routes
 
         try:
             with open(cls.ROUTES_FILE, 'r') as f:
-                data = yaml.safe_load(f)
+                data = yaml.load(f, Loader=YamlLoader)
                 
             if not data:
                 logger.warning("Routes file is empty")
-                return
+                return routes
                 
             for item in data:
                 try:
@@ -55,15 +112,17 @@ class Config:
                         topic_id = int(topic_id)
 
                     route = Route(
-                        name=str(item.get("name", "Unknown")),
+                        # Interned: the name is part of every dedup key and route_name comparison
+                        name=sys.intern(str(item.get("name", "Unknown"))),
                         source_id=int(item["sourceId"]),
                         target_id=int(item["targetId"]),
                         source_topic_id=topic_id
                     )
-                    cls.ROUTES.append(route)
+                    routes.append(route)
                 except KeyError as e:
                     logger.error(f"Missing required field in route config: {e}")
         except Exception as e:
             logger.error(f"Failed to load routes from {cls.ROUTES_FILE}: {e}")
+        return routes
 
-Config.load_routes()
+Config.compile_filters()
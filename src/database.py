@@ -1,77 +1,269 @@
+import asyncio
 import datetime
 import logging
-from typing import Optional
-from sqlalchemy import Column, Integer, String, DateTime, Index
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+from sqlalchemy import Column, Integer, String, DateTime, bindparam, event, func, text, update
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import declarative_base, load_only
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.future import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from src.config import Config
+from src.config import Config, Route
+from src.dedupe_cache import CacheKey, DeduplicationCache
 
 logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Applied to every new SQLite connection. WAL lets reads run alongside the single
+# writer and, with synchronous=NORMAL, avoids an fsync on every commit.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
 class ProcessedMessage(Base):
     __tablename__ = "processed_messages"
 
-    id = Column(Integer, primary_key=True)
-    route_name = Column(String, nullable=False) # e.g. "source:target"
-    source_chat_id = Column(Integer, nullable=False)
-    source_message_id = Column(Integer, nullable=False)
+    # The dedup key is the primary key of a WITHOUT ROWID table, so lookups are
+    # a single B-tree probe and inserts don't maintain a separate rowid tree.
+    route_name = Column(String, primary_key=True) # e.g. "source:target"
+    source_chat_id = Column(Integer, primary_key=True)
+    source_message_id = Column(Integer, primary_key=True)
     grouped_id = Column(Integer, nullable=True)
     target_message_id = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
-    # Unique constraint for single messages
-    __table_args__ = (
-        Index('idx_unique_message', 'route_name', 'source_chat_id', 'source_message_id', unique=True),
-    )
+    __table_args__ = {"sqlite_with_rowid": False}
 
 class Database:
     def __init__(self):
-        self.engine = create_async_engine(f"sqlite+aiosqlite:///{Config.DB_NAME}", echo=False)
+        # aiosqlite defaults to NullPool, which opens a connection (and thread) per session.
+        # Keep a long-lived pool instead; SQLite connections don't go stale, so no pings/recycling.
+        self.engine = create_async_engine(
+            f"sqlite+aiosqlite:///{Config.DB_NAME}",
+            echo=False,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=Config.DB_POOL_SIZE,
+            pool_pre_ping=False,
+            pool_recycle=-1,
+        )
+        event.listen(self.engine.sync_engine, "connect", _apply_sqlite_pragmas)
         self.async_session = async_sessionmaker(self.engine, expire_on_commit=False)
 
     async def init_db(self):
         async with self.engine.begin() as conn:
+            # A failed migration stops startup rather than running on a half-built table
+            await self._migrate_to_composite_key(conn)
             await conn.run_sync(Base.metadata.create_all)
-            
-            # Simple migration to add target_message_id if it's missing (e.g. from older schema)
-            # aiosqlite/sqlalchemy async doesn't easily support column check via metadata.create_all
-            from sqlalchemy import text
-            try:
-                # Check columns
-                result = await conn.execute(text("PRAGMA table_info(processed_messages)"))
-                columns = [row[1] for row in result.fetchall()]
-                if "target_message_id" not in columns:
-                    logger.info("Database migration: adding 'target_message_id' column to 'processed_messages'")
-                    await conn.execute(text("ALTER TABLE processed_messages ADD COLUMN target_message_id INTEGER"))
-            except Exception as e:
-                logger.error(f"Failed to run database migration: {e}")
 
-    async def get_session(self) -> AsyncSession:
+    @staticmethod
+    async def _table_columns(conn, table: str) -> List[str]:
+        result = await conn.execute(text(f"PRAGMA table_info({table})"))
+        return [row[1] for row in result.fetchall()]
+
+    @classmethod
+    async def _migrate_to_composite_key(cls, conn):
+        """Rebuilds the old rowid table (surrogate `id` + unique index) as WITHOUT ROWID.
+
+        Also finishes a rebuild that an older version left behind in
+        `processed_messages_old`.
+        """
+        leftover = bool(await cls._table_columns(conn, "processed_messages_old"))
+        if not leftover and "id" not in await cls._table_columns(conn, "processed_messages"):
+            return
+        logger.info("Database migration: rebuilding 'processed_messages' with a composite primary key")
+
+        # pysqlite runs DDL outside of any transaction; make the whole rebuild one
+        await conn.exec_driver_sql("BEGIN")
+        try:
+            if not leftover:
+                await conn.execute(text("ALTER TABLE processed_messages RENAME TO processed_messages_old"))
+                await conn.execute(text("DROP INDEX IF EXISTS idx_unique_message"))
+            # Older schemas may also predate target_message_id
+            old_columns = await cls._table_columns(conn, "processed_messages_old")
+            target_column = "target_message_id" if "target_message_id" in old_columns else "NULL"
+
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(text(
+                "INSERT OR IGNORE INTO processed_messages "
+                "(route_name, source_chat_id, source_message_id, grouped_id, target_message_id, created_at) "
+                f"SELECT route_name, source_chat_id, source_message_id, grouped_id, {target_column}, created_at "
+                "FROM processed_messages_old"
+            ))
+            await conn.execute(text("DROP TABLE processed_messages_old"))
+        except BaseException:
+            await conn.exec_driver_sql("ROLLBACK")
+            raise
+        await conn.exec_driver_sql("COMMIT")
+
+    def session(self) -> AsyncSession:
         return self.async_session()
 
 class Deduper:
     def __init__(self, db: Database):
         self.db = db
+        # Keys known to be processed (and their target ids), so repeat lookups skip SQLite
+        self.cache = DeduplicationCache(Config.DEDUP_CACHE_SIZE, Config.DEDUP_CACHE_TTL)
+        # Highest processed message id per (route_name, source_chat_id). Telegram ids only grow
+        # within a chat, so an id above the mark is certainly new and needs no SQLite lookup.
+        # None until load_high_water() runs; until then every check goes to the DB.
+        self._high_water: Optional[Dict[Tuple[str, int], int]] = None
+        # Target-id writes waiting for the background flusher; see start()
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._pending_targets: Dict[CacheKey, int] = {}
+        # Failed flushes per pending key, for the retry limit
+        self._write_retries: Dict[CacheKey, int] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Starts the background flusher that batches target-id writes into shared transactions.
+
+        Without it, update_target_message_id writes synchronously.
+        """
+        if self._flusher is None:
+            self._write_queue = asyncio.Queue()
+            self._flusher = asyncio.create_task(self._flush_writes())
+
+    async def stop(self):
+        """Writes out everything still queued and stops the flusher."""
+        if self._flusher is None:
+            return
+        await self._write_queue.join()
+        self._flusher.cancel()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        self._flusher = None
+        self._write_queue = None
+
+    async def _flush_writes(self):
+        stmt = (
+            update(ProcessedMessage.__table__)
+            .where(
+                ProcessedMessage.route_name == bindparam("b_route_name"),
+                ProcessedMessage.source_chat_id == bindparam("b_source_chat_id"),
+                ProcessedMessage.source_message_id == bindparam("b_source_message_id")
+            )
+            .values(target_message_id=bindparam("b_target_message_id"))
+        )
+        while True:
+            # Whatever queued up during the previous commit goes out in the next one
+            keys = [await self._write_queue.get()]
+            while len(keys) < Config.DB_WRITE_BATCH and not self._write_queue.empty():
+                keys.append(self._write_queue.get_nowait())
+            targets: Dict[CacheKey, int] = {}
+            try:
+                # Later writes to the same key supersede earlier ones
+                targets = {key: self._pending_targets[key] for key in keys if key in self._pending_targets}
+                if targets:
+                    params = [
+                        {
+                            "b_route_name": route_name,
+                            "b_source_chat_id": source_chat_id,
+                            "b_source_message_id": source_message_id,
+                            "b_target_message_id": target_message_id
+                        }
+                        for (route_name, source_chat_id, source_message_id), target_message_id in targets.items()
+                    ]
+                    async with self.db.session() as session:
+                        await session.execute(stmt, params)
+                        await session.commit()
+                    for key, target_message_id in targets.items():
+                        self._write_retries.pop(key, None)
+                        if self._pending_targets.get(key) == target_message_id:
+                            del self._pending_targets[key]
+            except Exception as e:
+                logger.error("Failed to write %d target ids: %s", len(keys), e, exc_info=True)
+                # Requeued before task_done, so stop() still waits for the retries.
+                # No backoff: busy_timeout already waits out a locked database.
+                dropped = 0
+                for key, target_message_id in targets.items():
+                    retries = self._write_retries.get(key, 0)
+                    if retries < Config.DB_WRITE_MAX_RETRIES:
+                        self._write_retries[key] = retries + 1
+                        self._write_queue.put_nowait(key)
+                        continue
+                    self._write_retries.pop(key, None)
+                    if self._pending_targets.get(key) == target_message_id:
+                        del self._pending_targets[key]
+                    dropped += 1
+                if dropped:
+                    logger.error("Dropped %d target ids after %d retries", dropped, Config.DB_WRITE_MAX_RETRIES)
+            finally:
+                for _ in keys:
+                    self._write_queue.task_done()
+
+    async def load_high_water(self):
+        """Hydrates the per-route high-water marks from SQLite; call once after init_db."""
+        async with self.db.session() as session:
+            stmt = select(
+                ProcessedMessage.route_name,
+                ProcessedMessage.source_chat_id,
+                func.max(ProcessedMessage.source_message_id)
+            ).group_by(ProcessedMessage.route_name, ProcessedMessage.source_chat_id)
+            result = await session.execute(stmt)
+            self._high_water = {(route_name, chat_id): max_id for route_name, chat_id, max_id in result}
+
+    def _is_above_high_water(self, route_name: str, source_chat_id: int, message_id: int) -> bool:
+        if self._high_water is None:
+            return False
+        return message_id > self._high_water.get((route_name, source_chat_id), 0)
+
+    def _raise_high_water(self, route_name: str, source_chat_id: int, message_id: int):
+        if self._high_water is None:
+            return
+        key = (route_name, source_chat_id)
+        if message_id > self._high_water.get(key, 0):
+            self._high_water[key] = message_id
+
+    def session(self) -> AsyncSession:
+        """Opens a session callers can keep and pass to the dedup methods."""
+        return self.db.session()
 
-    async def is_processed(self, route: Config.ROUTES[0].__class__, message_id: int) -> bool:
+    @asynccontextmanager
+    async def _use_session(self, session: Optional[AsyncSession]) -> AsyncIterator[AsyncSession]:
+        if session is not None:
+            yield session
+        else:
+            async with self.db.session() as session:
+                yield session
+
+    async def is_processed(self, route: Route, message_id: int, session: Optional[AsyncSession] = None) -> bool:
         # Use route.name from config as the unique identifier for the route configuration
         route_name = route.name
-        async with await self.db.get_session() as session:
+        key = (route_name, route.source_id, message_id)
+        if self.cache.is_duplicate(key):
+            return True
+        if self._is_above_high_water(route_name, route.source_id, message_id):
+            return False
+        async with self._use_session(session) as session:
             stmt = select(ProcessedMessage).where(
                 ProcessedMessage.route_name == route_name,
                 ProcessedMessage.source_chat_id == route.source_id,
                 ProcessedMessage.source_message_id == message_id
             )
             result = await session.execute(stmt)
-            return result.scalar_one_or_none() is not None
+            processed = result.scalar_one_or_none() is not None
+        if processed:
+            self.cache.add(key)
+        return processed
 
-    async def add_processed(self, route: Config.ROUTES[0].__class__, message_id: int, grouped_id: Optional[int] = None):
+    async def add_processed(self, route: Route, message_id: int, grouped_id: Optional[int] = None, session: Optional[AsyncSession] = None):
         route_name = route.name
-        async with await self.db.get_session() as session:
+        async with self._use_session(session) as session:
             try:
                 msg = ProcessedMessage(
                     route_name=route_name,
@@ -85,26 +277,112 @@ class Deduper:
                 # E.g. UniqueViolation if race condition, though queue should prevent it
                 await session.rollback()
                 raise e
+        self.cache.add((route_name, route.source_id, message_id))
+        self._raise_high_water(route_name, route.source_id, message_id)
 
-    async def get_target_message_id(self, route_name: str, source_chat_id: int, source_message_id: int) -> Optional[int]:
-        async with await self.db.get_session() as session:
-            stmt = select(ProcessedMessage.target_message_id).where(
-                ProcessedMessage.route_name == route_name,
-                ProcessedMessage.source_chat_id == source_chat_id,
-                ProcessedMessage.source_message_id == source_message_id
+    async def try_mark_processed(self, route: Route, message_id: int, grouped_id: Optional[int] = None, session: Optional[AsyncSession] = None) -> bool:
+        """Marks the message processed in one INSERT OR IGNORE round-trip.
+
+        Returns True if this call inserted the row, False if it was already processed.
+        """
+        key = (route.name, route.source_id, message_id)
+        if self.cache.is_duplicate(key):
+            return False
+        stmt = (
+            sqlite_insert(ProcessedMessage)
+            .values(
+                route_name=route.name,
+                source_chat_id=route.source_id,
+                source_message_id=message_id,
+                grouped_id=grouped_id
             )
-            result = await session.execute(stmt)
-            return result.scalar_one_or_none()
+            .on_conflict_do_nothing()
+            .returning(ProcessedMessage.source_message_id)
+        )
+        async with self._use_session(session) as session:
+            try:
+                result = await session.execute(stmt)
+                inserted = result.scalar_one_or_none() is not None
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+        self.cache.add(key)
+        self._raise_high_water(route.name, route.source_id, message_id)
+        return inserted
 
-    async def update_target_message_id(self, route_name: str, source_chat_id: int, source_message_id: int, target_message_id: int):
-        async with await self.db.get_session() as session:
-            stmt = select(ProcessedMessage).where(
-                ProcessedMessage.route_name == route_name,
+    async def bulk_mark_processed(self, rows: List[Dict[str, Any]], session: Optional[AsyncSession] = None):
+        """Marks several messages processed with a single executemany INSERT OR IGNORE and one commit.
+
+        Each row holds route_name, source_chat_id, source_message_id and grouped_id.
+        """
+        if not rows:
+            return
+        stmt = sqlite_insert(ProcessedMessage).on_conflict_do_nothing()
+        async with self._use_session(session) as session:
+            try:
+                await session.execute(stmt, rows)
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+        for row in rows:
+            self.cache.add((row["route_name"], row["source_chat_id"], row["source_message_id"]))
+            self._raise_high_water(row["route_name"], row["source_chat_id"], row["source_message_id"])
+
+    async def bulk_filter_processed(self, route_names: List[str], source_chat_id: int, message_ids: List[int]) -> Set[Tuple[str, int]]:
+        """Returns the (route_name, source_message_id) pairs among the given ones that are already processed."""
+        if not route_names or not message_ids:
+            return set()
+        if self._high_water is not None:
+            # Only ids at or below some route's mark can have been processed
+            ceiling = max(self._high_water.get((name, source_chat_id), 0) for name in route_names)
+            message_ids = [mid for mid in message_ids if mid <= ceiling]
+            if not message_ids:
+                return set()
+        async with self.db.session() as session:
+            stmt = select(ProcessedMessage.route_name, ProcessedMessage.source_message_id).where(
+                ProcessedMessage.route_name.in_(route_names),
                 ProcessedMessage.source_chat_id == source_chat_id,
-                ProcessedMessage.source_message_id == source_message_id
+                ProcessedMessage.source_message_id.in_(message_ids)
             )
             result = await session.execute(stmt)
-            msg = result.scalar_one_or_none()
+            return {(row.route_name, row.source_message_id) for row in result}
+
+    async def get_target_message_id(self, route_name: str, source_chat_id: int, source_message_id: int) -> Optional[int]:
+        key = (route_name, source_chat_id, source_message_id)
+        target_message_id = self.cache.get_target(key)
+        if target_message_id is not None:
+            return target_message_id
+        target_message_id = self._pending_targets.get(key)
+        if target_message_id is not None:
+            # Not flushed yet; the DB would still say None
+            return target_message_id
+        async with self.db.session() as session:
+            # Primary-key lookup: no select() to build and compile per call
+            msg = await session.get(
+                ProcessedMessage,
+                key,
+                options=[load_only(ProcessedMessage.target_message_id)]
+            )
+            target_message_id = msg.target_message_id if msg else None
+        if target_message_id is not None:
+            self.cache.add(key, target_message_id)
+        return target_message_id
+
+    async def update_target_message_id(self, route_name: str, source_chat_id: int, source_message_id: int, target_message_id: int):
+        key = (route_name, source_chat_id, source_message_id)
+        if self._write_queue is not None:
+            # Nothing waits on this write, so it joins the flusher's next batch
+            self._pending_targets[key] = target_message_id
+            self._write_queue.put_nowait(key)
+            self.cache.add(key, target_message_id)
+            return
+        async with self.db.session() as session:
+            msg = await session.get(ProcessedMessage, key)
             if msg:
                 msg.target_message_id = target_message_id
                 await session.commit()
+        if msg:
+            # Replies to this message usually follow soon; serve them from memory
+            self.cache.add(key, target_message_id)
@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# (route_name, source_chat_id, source_message_id)
+CacheKey = Tuple[str, int, int]
+
+class DeduplicationCache:
+    """Bounded LRU of processed message keys with a TTL.
+
+    Entries also carry the target message id once it is known, so reply lookups
+    for recently forwarded messages are answered from memory.
+    """
+
+    def __init__(self, max_size: int = 100_000, ttl: float = 24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[CacheKey, Tuple[Optional[int], float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: CacheKey) -> Optional[Tuple[Optional[int], float]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def is_duplicate(self, key: CacheKey) -> bool:
+        return self._lookup(key) is not None
+
+    def get_target(self, key: CacheKey) -> Optional[int]:
+        entry = self._lookup(key)
+        return entry[0] if entry else None
+
+    def add(self, key: CacheKey, target_message_id: Optional[int] = None):
+        if target_message_id is None:
+            # Don't forget a target id we already know
+            entry = self._entries.get(key)
+            if entry is not None:
+                target_message_id = entry[0]
+        self._entries[key] = (target_message_id, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -1,10 +1,11 @@
 import asyncio
 import logging
-import datetime
 import os
-from collections import defaultdict
-from typing import Dict, List, Optional, Set, Tuple
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
 
+from sqlalchemy.ext.asyncio import AsyncSession
 from telethon import TelegramClient, events
 from telethon.tl.types import Message
 
@@ -15,21 +16,47 @@ from src.normalizer import Normalizer, UnifiedMessage
 logger = logging.getLogger(__name__)
 
 class Listener:
-    def __init__(self, deduper: Deduper, queue: asyncio.Queue):
+    def __init__(self, deduper: Deduper, queues: Sequence[asyncio.Queue]):
         self.client = TelegramClient(Config.SESSION_NAME, Config.API_ID, Config.API_HASH)
         self.deduper = deduper
-        self.queue = queue
+        # Sender queues, one per worker; see _dispatch
+        self.queues = queues
         
         # Per-chat processing
         self.chat_queues: Dict[int, asyncio.Queue] = {}
-        self.chat_tasks: Dict[int, asyncio.Task] = {}
+        # Ordered by recent activity; capped at Config.MAX_ACTIVE_CHATS
+        self.chat_tasks: "OrderedDict[int, asyncio.Task]" = OrderedDict()
+        # Evicted chats whose processors exit once their queue runs dry
+        self._retiring: Set[int] = set()
         self.polling_task: Optional[asyncio.Task] = None
+        self._task_group: Optional[asyncio.TaskGroup] = None
+        # Caps parallel media downloads; more connections mostly earns FloodWaits
+        self.download_semaphore = asyncio.Semaphore(Config.DOWNLOAD_CONCURRENCY)
         self.last_seen: Dict[int, int] = {}
         
         # Route lookups
-        self.source_routes: Dict[int, List[Route]] = defaultdict(list)
-        for route in Config.ROUTES:
-            self.source_routes[route.source_id].append(route)
+        self.source_routes: Dict[int, Tuple[Route, ...]] = {}
+        self.routes_by_topic: Dict[Tuple[int, Optional[int]], Tuple[Route, ...]] = {}
+        self._index_routes(Config.routes())
+
+    def _index_routes(self, routes: List[Route]):
+        by_source: Dict[int, List[Route]] = defaultdict(list)
+        by_topic: Dict[Tuple[int, Optional[int]], List[Route]] = defaultdict(list)
+        for route in routes:
+            by_source[route.source_id].append(route)
+            # Routes without a topic are keyed by (source_id, None) and match every message
+            by_topic[(route.source_id, route.source_topic_id)].append(route)
+        # Frozen into plain dicts of tuples: the hot path only reads them
+        self.source_routes = {key: tuple(group) for key, group in by_source.items()}
+        self.routes_by_topic = {key: tuple(group) for key, group in by_topic.items()}
+
+    def _routes_for(self, chat_id: int, message: Message) -> Tuple[Route, ...]:
+        """Routes of this chat matching the message's topic, found with one topic extraction."""
+        routes = self.routes_by_topic.get((chat_id, None), ())
+        topic_id = self._extract_topic_id(message)
+        if topic_id is not None:
+            routes = self.routes_by_topic.get((chat_id, topic_id), ()) + routes
+        return routes
 
     async def start(self):
         logger.info("Starting Telethon Client...")
@@ -38,26 +65,50 @@ class Listener:
         # Register event handler
         self.client.add_event_handler(self._handle_new_message, events.NewMessage())
         
-        if Config.POLLING_INTERVAL > 0:
-            self.polling_task = asyncio.create_task(self._poll_sources())
-        
-        logger.info("Listener started.")
-        await self.client.run_until_disconnected()
+        # Poller and chat processors live in one task group, bounded by the client's lifetime
+        async with asyncio.TaskGroup() as tg:
+            self._task_group = tg
+            if Config.POLLING_INTERVAL > 0:
+                self.polling_task = tg.create_task(self._poll_sources())
+            
+            logger.info("Listener started.")
+            try:
+                await self.client.run_until_disconnected()
+            finally:
+                # Late NewMessage events are dropped from here on instead of starting processors
+                self._task_group = None
+                # The workers never return on their own; stop them so the group can exit
+                if self.polling_task:
+                    self.polling_task.cancel()
+                for task in self.chat_tasks.values():
+                    task.cancel()
 
     async def _handle_new_message(self, event: events.NewMessage.Event):
         message: Message = event.message
         chat_id = message.chat_id
+        # Unrouted chats would only take processor slots from real sources
+        if chat_id not in self.source_routes:
+            return
         self._update_last_seen(chat_id, message.id)
-        
-        if chat_id not in self.chat_queues:
-            self.chat_queues[chat_id] = asyncio.Queue()
-            self.chat_tasks[chat_id] = asyncio.create_task(self._chat_processor(chat_id))
-            
-        await self.chat_queues[chat_id].put((message, False))
+        await self._enqueue(chat_id, (message, False))
+
+    async def _chat_processor(self, chat_id: int, queue: asyncio.Queue):
+        try:
+            await self._process_chat(chat_id, queue)
+        except Exception as e:
+            # Escaping into the task group would cancel the poller and every other chat
+            logger.error("Chat processor %s crashed: %s", chat_id, e, exc_info=True)
+        finally:
+            # However it ended, the next message for this chat gets a fresh processor
+            self._forget_chat(chat_id, queue)
 
-    async def _chat_processor(self, chat_id: int):
-        """Processes messages for a specific chat sequentially."""
-        logger.debug(f"Started processor for chat {chat_id}")
+    async def _process_chat(self, chat_id: int, queue: asyncio.Queue):
+        """Processes messages for a specific chat sequentially.
+
+        A chat has at most one processor: it stays registered until it exits,
+        and it only exits with an empty queue (idle, or drained after eviction).
+        """
+        logger.debug("Started processor for chat %s", chat_id)
         
         # Buffer for albums
         album_id: Optional[int] = None
@@ -69,8 +120,9 @@ class Listener:
                 # If we have a pending album, wait with timeout
                 if album_id is not None:
                     try:
-                        # Wait for next part or flush
-                        message, allow_old = await asyncio.wait_for(self.chat_queues[chat_id].get(), timeout=2.0)
+                        # Wait for next part or flush; the window restarts with every part
+                        async with asyncio.timeout(Config.ALBUM_FLUSH_TIMEOUT):
+                            item = await queue.get()
                     except asyncio.TimeoutError:
                         # Flush album
                         await self._flush_album(album_route, album_messages)
@@ -79,71 +131,139 @@ class Listener:
                         album_route = None
                         continue
                 else:
-                    # Normal wait
-                    message, allow_old = await self.chat_queues[chat_id].get()
+                    # Normal wait; an idle processor retires and is respawned by the next message
+                    try:
+                        async with asyncio.timeout(Config.CHAT_IDLE_TIMEOUT):
+                            item = await queue.get()
+                    except asyncio.TimeoutError:
+                        if not queue.empty():
+                            continue
+                        self._forget_chat(chat_id, queue)
+                        logger.debug("Stopped idle processor for chat %s", chat_id)
+                        return
 
-                # Process message
-                possible_routes = self.source_routes.get(chat_id)
-                if not possible_routes:
-                    self.chat_queues[chat_id].task_done()
-                    continue
+                # Take whatever else is already queued too: one wakeup handles a burst
+                batch = [item]
+                while len(batch) < Config.CHAT_DRAIN_BATCH and not queue.empty():
+                    batch.append(queue.get_nowait())
+            except Exception as e:
+                logger.error("Error in chat processor %s: %s", chat_id, e, exc_info=True)
+                continue
 
-                for route in possible_routes:
-                    if not self._should_process(message, route, allow_old=allow_old):
-                        continue
-                    
-                    if await self.deduper.is_processed(route, message.id):
-                        continue
+            # A short-lived session per batch: an idle processor holds no pooled connection
+            async with self.deduper.session() as session:
+                now = time.time()
+                for item in batch:
+                    try:
+                        if item is None:
+                            # Eviction wakeup; the retire check below runs after the batch
+                            continue
+                        message, allow_old = item
 
-                    if message.grouped_id:
-                        # Start or continue album
-                        if album_id == message.grouped_id:
-                            album_messages.append(message)
-                        else:
-                            # If a NEW album starts before old one flushed (unlikely in same chat?)
-                            if album_id is not None:
-                                await self._flush_album(album_route, album_messages)
+                        # Cheapest filters first, all before any DB work: age rejects a replayed
+                        # backlog without even a route lookup, then topic routing, then the blacklist.
+                        # None of them depend on the route, so they run once per message.
+                        if not allow_old and self._is_too_old(message, now):
+                            continue
+                        possible_routes = self._routes_for(chat_id, message)
+                        if not possible_routes or self._is_blacklisted(message):
+                            continue
+
+                        for route in possible_routes:
+                            if message.grouped_id:
+                                # Album parts are marked processed in one batch when the album is flushed
+                                if await self.deduper.is_processed(route, message.id, session=session):
+                                    continue
+
+                                # Start or continue album
+                                if album_id == message.grouped_id:
+                                    # Same part may arrive from both the event handler and the poller
+                                    if any(m.id == message.id for m in album_messages):
+                                        continue
+                                    album_messages.append(message)
+                                else:
+                                    # If a NEW album starts before old one flushed (unlikely in same chat?)
+                                    if album_id is not None:
+                                        await self._flush_album(album_route, album_messages, session)
+                                
+                                    album_id = message.grouped_id
+                                    album_messages = [message]
+                                    album_route = route
+                            else:
+                                if not await self.deduper.try_mark_processed(route, message.id, session=session):
+                                    continue
+
+                                # If a single message arrives during an album collecting...
+                                # In Telegram, albums are usually sent Together. 
+                                # But if a single message arrives, we should probably flush album first 
+                                # to preserve order if the single message was meant to be AFTER.
+                                if album_id is not None:
+                                    await self._flush_album(album_route, album_messages, session)
+                                    album_id = None
+                                    album_messages = []
                             
-                            album_id = message.grouped_id
-                            album_messages = [message]
-                            album_route = route
-                        
-                        # Mark processed in DB now to prevent dups if album takes long
-                        await self.deduper.add_processed(route, message.id, grouped_id=album_id)
-                    else:
-                        # If a single message arrives during an album collecting...
-                        # In Telegram, albums are usually sent Together. 
-                        # But if a single message arrives, we should probably flush album first 
-                        # to preserve order if the single message was meant to be AFTER.
-                        if album_id is not None:
-                            await self._flush_album(album_route, album_messages)
-                            album_id = None
-                            album_messages = []
-                        
-                        await self._process_single_message(message, route)
-                
-                self.chat_queues[chat_id].task_done()
+                                await self._process_single_message(message, route)
 
-            except Exception as e:
-                logger.error(f"Error in chat processor {chat_id}: {e}", exc_info=True)
+                    except Exception as e:
+                        logger.error("Error in chat processor %s: %s", chat_id, e, exc_info=True)
+                    finally:
+                        queue.task_done()
+
+            if chat_id in self._retiring and queue.empty():
+                # Evicted from the active set: finish the pending album, then exit
+                # unless the flush let new messages in or revived the chat
+                if album_id is not None:
+                    await self._flush_album(album_route, album_messages)
+                    album_id = None
+                    album_messages = []
+                    album_route = None
+                if chat_id in self._retiring and queue.empty():
+                    self._forget_chat(chat_id, queue)
+                    logger.debug("Stopped evicted processor for chat %s", chat_id)
+                    return
 
     async def _poll_sources(self):
         await self._init_last_seen()
         while True:
             try:
-                for source_id in self.source_routes.keys():
-                    min_id = self.last_seen.get(source_id, 0)
-                    async for message in self.client.iter_messages(
-                        source_id, min_id=min_id, reverse=True
-                    ):
-                        self._update_last_seen(source_id, message.id)
-                        await self._ensure_chat_queue(source_id)
-                        await self.chat_queues[source_id].put((message, True))
+                # Sources are polled concurrently so one slow chat doesn't hold up the rest
+                results = await asyncio.gather(
+                    *(self._poll_one(source_id) for source_id in self.source_routes),
+                    return_exceptions=True
+                )
+                for source_id, result in zip(self.source_routes, results):
+                    if isinstance(result, Exception):
+                        logger.error("Polling error for %s: %s", source_id, result, exc_info=result)
                 await asyncio.sleep(Config.POLLING_INTERVAL)
             except Exception as e:
-                logger.error(f"Polling error: {e}", exc_info=True)
+                logger.error("Polling error: %s", e, exc_info=True)
                 await asyncio.sleep(max(Config.POLLING_INTERVAL, 1))
 
+    async def _poll_one(self, source_id: int):
+        min_id = self.last_seen.get(source_id, 0)
+        messages = [
+            message async for message in self.client.iter_messages(
+                source_id, min_id=min_id, reverse=True, limit=Config.POLL_BATCH_SIZE
+            )
+        ]
+        if not messages:
+            return
+
+        # One dedup query for the whole batch instead of one per message downstream
+        route_names = [route.name for route in self.source_routes[source_id]]
+        processed = await self.deduper.bulk_filter_processed(
+            route_names, source_id, [message.id for message in messages]
+        )
+
+        for message in messages:
+            routes = self._routes_for(source_id, message)
+            # Nothing left to do if every matching route has already handled it
+            if not all((route.name, message.id) in processed for route in routes):
+                await self._enqueue(source_id, (message, True))
+            # Advanced only once the message is handed off: if the filter or an enqueue
+            # fails, the next poll fetches the rest of the batch again
+            self._update_last_seen(source_id, message.id)
+
     async def _init_last_seen(self):
         for source_id in self.source_routes.keys():
             try:
@@ -151,41 +271,115 @@ class Listener:
                 if msgs:
                     self.last_seen[source_id] = msgs[0].id
             except Exception as e:
-                logger.warning(f"Failed to init last_seen for {source_id}: {e}")
+                logger.warning("Failed to init last_seen for %s: %s", source_id, e)
 
     def _update_last_seen(self, chat_id: int, message_id: int):
         current = self.last_seen.get(chat_id, 0)
         if message_id > current:
             self.last_seen[chat_id] = message_id
 
-    async def _ensure_chat_queue(self, chat_id: int):
-        if chat_id not in self.chat_queues:
-            self.chat_queues[chat_id] = asyncio.Queue()
-            self.chat_tasks[chat_id] = asyncio.create_task(self._chat_processor(chat_id))
+    async def _enqueue(self, chat_id: int, item: Tuple[Message, bool]):
+        while True:
+            queue = self._ensure_chat_queue(chat_id)
+            if queue is None:
+                logger.debug("Listener stopped; dropping message for chat %s", chat_id)
+                return
+            await queue.put(item)
+            # A processor only exits with an empty queue, so if it retired while this put
+            # was waiting, whatever is left in its queue still needs a live processor
+            if self.chat_queues.get(chat_id) is queue or queue.empty():
+                return
+            item = queue.get_nowait()
+            queue.task_done()
 
-    async def _process_single_message(self, message: Message, route: Route):
+    def _ensure_chat_queue(self, chat_id: int) -> Optional[asyncio.Queue]:
+        """Returns the chat's queue, starting its processor if needed; None once the listener stopped."""
+        queue = self.chat_queues.get(chat_id)
+        if queue is not None:
+            self.chat_tasks.move_to_end(chat_id)
+            # New traffic cancels a pending eviction
+            self._retiring.discard(chat_id)
+            return queue
+        if self._task_group is None:
+            return None
+        if len(self.chat_tasks) - len(self._retiring) >= Config.MAX_ACTIVE_CHATS:
+            # Retire the least recently active chat; its processor keeps the chat until
+            # its queue is drained, so a chat never has two processors at once
+            evicted_id = next(cid for cid in self.chat_tasks if cid not in self._retiring)
+            self._retiring.add(evicted_id)
+            try:
+                # Wakes an idle processor; a full queue means it is busy and will notice anyway
+                self.chat_queues[evicted_id].put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        queue = asyncio.Queue(maxsize=Config.CHAT_QUEUE_MAX)
+        self.chat_queues[chat_id] = queue
+        self.chat_tasks[chat_id] = self._task_group.create_task(self._chat_processor(chat_id, queue))
+        return queue
+
+    def _forget_chat(self, chat_id: int, queue: asyncio.Queue):
+        # Only drop the entries if they still belong to this processor
+        if self.chat_queues.get(chat_id) is queue:
+            del self.chat_queues[chat_id]
+            del self.chat_tasks[chat_id]
+            self._retiring.discard(chat_id)
+
+    async def _dispatch(self, route: Route, payload: Union[UnifiedMessage, List[UnifiedMessage]]):
+        # Same target -> same worker, so replies are sent after the messages they point to
+        queue = self.queues[hash(route.target_id) % len(self.queues)]
+        await queue.put((route, payload))
+
+    async def _normalize_and_download(self, message: Message) -> UnifiedMessage:
         unified_msg = await Normalizer.normalize(message)
         if unified_msg.media_type:
-            path = await self.client.download_media(message, file="src/tmp/")
-            unified_msg.media_path = path
+            media_file = message.file
+            size = media_file.size if media_file else None
+            async with self.download_semaphore:
+                if size is not None and size <= Config.MEDIA_IN_MEMORY_LIMIT:
+                    # Skips writing the file out only for the sender to read it back and delete it
+                    unified_msg.media_bytes = await self.client.download_media(message, file=bytes)
+                    unified_msg.media_name = media_file.name or f"{message.id}{media_file.ext or ''}"
+                else:
+                    unified_msg.media_path = await self.client.download_media(message, file="src/tmp/")
+        return unified_msg
 
-        await self.queue.put((route, unified_msg))
-        await self.deduper.add_processed(route, message.id)
+    async def _process_single_message(self, message: Message, route: Route):
+        unified_msg = await self._normalize_and_download(message)
+        await self._dispatch(route, unified_msg)
 
-    async def _flush_album(self, route: Route, messages: List[Message]):
+    async def _flush_album(self, route: Route, messages: List[Message], session: Optional[AsyncSession] = None):
         if not messages or not route:
             return
             
         messages.sort(key=lambda m: m.id)
+
+        # One insert and commit for the whole album instead of one per part
+        rows = [
+            {
+                "route_name": route.name,
+                "source_chat_id": route.source_id,
+                "source_message_id": m.id,
+                "grouped_id": m.grouped_id
+            }
+            for m in messages
+        ]
+        await self.deduper.bulk_mark_processed(rows, session=session)
+
+        # Album parts download in parallel; gather keeps them in message order
+        results = await asyncio.gather(
+            *(self._normalize_and_download(m) for m in messages),
+            return_exceptions=True
+        )
         unified_group = []
-        for msg in messages:
-            uni = await Normalizer.normalize(msg)
-            if uni.media_type:
-                path = await self.client.download_media(msg, file="src/tmp/")
-                uni.media_path = path
-            unified_group.append(uni)
-            
-        await self.queue.put((route, unified_group))
+        for msg, result in zip(messages, results):
+            if isinstance(result, Exception):
+                # Losing one part shouldn't drop the rest of the album
+                logger.error("Failed to prepare album part %s: %s", msg.id, result)
+                continue
+            unified_group.append(result)
+
+        if unified_group:
+            await self._dispatch(route, unified_group)
 
     @staticmethod
     def _extract_topic_id(message: Message) -> Optional[int]:
@@ -193,33 +387,37 @@ class Listener:
         topic_id = getattr(message, "reply_to_top_id", None)
         if topic_id:
             return topic_id
-        if message.reply_to:
-            topic_id = getattr(message.reply_to, "reply_to_top_id", None)
+        reply_to = message.reply_to
+        if reply_to is None:
+            return None
+        # MessageReplyHeader has these fields; try/except is free when they exist
+        try:
+            topic_id = reply_to.reply_to_top_id
             if topic_id:
                 return topic_id
-            if getattr(message.reply_to, "forum_topic", False):
-                return getattr(message.reply_to, "reply_to_msg_id", None)
+        except AttributeError:
+            pass
+        try:
+            if reply_to.forum_topic:
+                return reply_to.reply_to_msg_id
+        except AttributeError:
+            pass
         return None
 
-    def _should_process(self, message: Message, route: Route, allow_old: bool = False) -> bool:
-        # 1. Time filter
-        if not allow_old:
-            now = datetime.datetime.now(datetime.timezone.utc)
-            if (now - message.date).total_seconds() > 300:
-                return False
-
-        # 2. Topic filter
-        if route.source_topic_id:
-            current_thread = self._extract_topic_id(message)
-            if current_thread != route.source_topic_id:
-                return False
-                
-        # 3. Content Filter
-        text_content = message.message or ""
-        if text_content:
-            lower_text = text_content.lower()
-            for word in Config.BLACKLIST_WORDS:
-                if word in lower_text:
-                    logger.info(f"Skipping message {message.id}: contains blacklist word '{word}'")
-                    return False
-        return True
+    @staticmethod
+    def _is_too_old(message: Message, now: float) -> bool:
+        return (now - message.date.timestamp()) > 300
+
+    @staticmethod
+    def _is_blacklisted(message: Message) -> bool:
+        text_content = message.message
+        if not text_content or Config.BLACKLIST_RE is None:
+            # Media-only messages have no text to scan
+            return False
+        match = Config.BLACKLIST_RE.search(text_content)
+        if match:
+            # Noisy sources hit this constantly; skip building the record when INFO is off
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Skipping message %s: contains blacklist word '%s'", message.id, match.group(0).lower())
+            return True
+        return False
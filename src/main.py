@@ -13,6 +13,15 @@ from src.normalizer import UnifiedMessage
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _remove_files(paths: List[str]):
+    # Blocking filesystem calls; run via asyncio.to_thread, one hop per batch
+    for path in paths:
+        # One unlink instead of stat + unlink; missing files are fine
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
 async def sender_worker(queue: asyncio.Queue, sender: BotSender, deduper: Deduper):
     logger.info("Sender worker started")
     while True:
@@ -46,9 +55,7 @@ async def sender_worker(queue: asyncio.Queue, sender: BotSender, deduper: Dedupe
                             )
 
                 # Cleanup tmp files
-                for msg in msgs:
-                    if msg.media_path and os.path.exists(msg.media_path):
-                        os.remove(msg.media_path)
+                await asyncio.to_thread(_remove_files, [msg.media_path for msg in msgs if msg.media_path])
             else:
                 # Single message
                 msg = payload
@@ -65,32 +72,36 @@ async def sender_worker(queue: asyncio.Queue, sender: BotSender, deduper: Dedupe
                         route.name, msg.source_chat_id, msg.source_message_id, target_message_id
                     )
 
-                if msg.media_path and os.path.exists(msg.media_path):
-                    os.remove(msg.media_path)
+                if msg.media_path:
+                    await asyncio.to_thread(_remove_files, [msg.media_path])
                     
             queue.task_done()
         except asyncio.CancelledError:
             break
         except Exception as e:
-            logger.error(f"Worker error: {e}", exc_info=True)
+            logger.error("Worker error: %s", e, exc_info=True)
 
 async def main():
     # Init DB
     db = Database()
     await db.init_db()
     deduper = Deduper(db)
+    await deduper.load_high_water()
+    deduper.start()
     
-    # Init Queue
-    queue = asyncio.Queue()
+    # Init Queues: one per sender worker; the listener shards by target chat so sends
+    # to one target stay ordered while a slow target doesn't block the others.
+    # Bounded, so a stalled worker pushes back on the listener instead of piling up media.
+    queues = [asyncio.Queue(maxsize=Config.SENDER_QUEUE_MAX) for _ in range(Config.SENDER_WORKERS)]
     
     # Init Sender
     sender = BotSender()
     
-    # Start Worker
-    worker_task = asyncio.create_task(sender_worker(queue, sender, deduper))
+    # Start Workers
+    worker_tasks = [asyncio.create_task(sender_worker(queue, sender, deduper)) for queue in queues]
     
     # Init Listener
-    listener = Listener(deduper, queue)
+    listener = Listener(deduper, queues)
     
     logger.info("Service initialized. Press Ctrl+C to stop.")
     
@@ -99,12 +110,17 @@ async def main():
     except KeyboardInterrupt:
         logger.info("Stopping...")
     finally:
-        worker_task.cancel()
-        try:
-            await worker_task
-        except asyncio.CancelledError:
-            pass
+        for worker_task in worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*worker_tasks, return_exceptions=True)
+        await deduper.stop()
         logger.info("Stopped.")
 
 if __name__ == "__main__":
+    # libuv-based event loop where available; the stdlib loop otherwise
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())
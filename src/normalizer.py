@@ -1,13 +1,19 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import List, Optional, Union, Any
 from datetime import datetime
+from aiogram.types import MessageEntity
 from telethon import types, utils
 
-@dataclass
+@dataclass(slots=True)
 class UnifiedMessage:
     text: str = ""
-    entities: List[Any] = field(default_factory=list)
+    # None until normalize() maps the source entities
+    entities: Optional[List[MessageEntity]] = None
     media_path: Optional[str] = None
+    # Small media is held in memory instead of media_path; media_name is its upload filename
+    media_bytes: Optional[bytes] = None
+    media_name: Optional[str] = None
     media_type: Optional[str] = None # photo, video, document, audio, voice, sticker, animation
     grouped_id: Optional[int] = None
     reply_to_msg_id: Optional[int] = None # If we want to support threaded replies in target later
@@ -16,21 +22,54 @@ class UnifiedMessage:
     source_chat_id: int = 0
     source_topic_id: Optional[int] = None
     source_message_id: int = 0
-    date: datetime = field(default_factory=datetime.utcnow)
+    date: Optional[datetime] = None # Always set from the source message by normalize()
     
     # For album grouping
     is_album_part: bool = False
     
+# Telethon entity class -> (Bot API type, extractor for type-specific fields).
+# Keyed by exact class: one dict lookup per entity instead of an isinstance chain.
+_ENTITY_MAP = {
+    types.MessageEntityBold: ("bold", None),
+    types.MessageEntityItalic: ("italic", None),
+    types.MessageEntityCode: ("code", None),
+    types.MessageEntityPre: ("pre", lambda e: {"language": e.language}),
+    types.MessageEntityTextUrl: ("text_link", lambda e: {"url": e.url}),
+    types.MessageEntityUrl: ("url", None),
+    types.MessageEntityMention: ("mention", None),
+    types.MessageEntityUnderline: ("underline", None),
+    types.MessageEntityStrike: ("strikethrough", None),
+    types.MessageEntitySpoiler: ("spoiler", None),
+    types.MessageEntityCustomEmoji: ("custom_emoji", lambda e: {"custom_emoji_id": str(e.document_id)}),
+}
+
+# Documents with these MIME types are sent as stickers even when Telethon doesn't flag them
+_STICKER_MIMES = frozenset({"image/webp", "application/x-tgsticker", "video/webm"})
+_ANIMATED = types.DocumentAttributeAnimated
+
+@lru_cache(maxsize=1024)
+def _footer_entity(offset: int, length: int) -> MessageEntity:
+    # Shared per offset; entities are never mutated after normalization
+    return MessageEntity(type="mention", offset=offset, length=length)
+
 class Normalizer:
     @staticmethod
     def get_effective_text(message: types.Message) -> str:
         return message.message or ""
 
     @staticmethod
-    def map_entities(telethon_entities: List[types.TypeMessageEntity], text: str) -> List[dict]:
+    def utf16_len(text: str) -> int:
+        # ASCII and BMP chars are one UTF-16 unit, astral chars (most emoji) are a surrogate pair.
+        # Counting avoids allocating the encoded copy of every message.
+        if text.isascii():
+            return len(text)
+        return len(text) + sum(1 for c in text if ord(c) > 0xFFFF)
+
+    @staticmethod
+    def map_entities(telethon_entities: List[types.TypeMessageEntity], text: str) -> List[MessageEntity]:
         """
-        Convert Telethon entities to Bot API compatible entities (dict format for now, 
-        or aiogram types if we imported them).
+        Convert Telethon entities to aiogram MessageEntity objects, validated once here
+        so the sender can pass them straight through (including on retries).
         
         Bot API Entity Types:
         mention, hashtag, cashtag, bot_command, url, email, phone_number, bold, italic, 
@@ -41,48 +80,20 @@ class Normalizer:
             
         api_entities = []
         
-        # Telethon and Bot API both use offset/length logic primarily.
-        # However, Telethon entities are objects, Bot API expects JSON-serializable usually 
-        # or Aiogram MessageEntity objects. We will return dicts for simplicity in passing to Sender.
+        # Telethon and Bot API both use offset/length logic, so only the type needs translating.
         
         for entity in telethon_entities:
-            entity_type = None
-            extra = {}
-            
-            if isinstance(entity, types.MessageEntityBold):
-                entity_type = "bold"
-            elif isinstance(entity, types.MessageEntityItalic):
-                entity_type = "italic"
-            elif isinstance(entity, types.MessageEntityCode):
-                entity_type = "code"
-            elif isinstance(entity, types.MessageEntityPre):
-                entity_type = "pre"
-                extra["language"] = entity.language
-            elif isinstance(entity, types.MessageEntityTextUrl):
-                entity_type = "text_link"
-                extra["url"] = entity.url
-            elif isinstance(entity, types.MessageEntityUrl):
-                entity_type = "url"
-            elif isinstance(entity, types.MessageEntityMention):
-                entity_type = "mention"
-            elif isinstance(entity, types.MessageEntityUnderline):
-                entity_type = "underline"
-            elif isinstance(entity, types.MessageEntityStrike):
-                entity_type = "strikethrough"
-            elif isinstance(entity, types.MessageEntitySpoiler):
-                entity_type = "spoiler"
-            elif isinstance(entity, types.MessageEntityCustomEmoji):
-                entity_type = "custom_emoji"
-                extra["custom_emoji_id"] = str(entity.document_id)
-
-            if entity_type:
-                data = {
-                    "type": entity_type,
-                    "offset": entity.offset,
-                    "length": entity.length
-                }
-                data.update(extra)
-                api_entities.append(data)
+            entry = _ENTITY_MAP.get(type(entity))
+            if entry is None:
+                continue
+            entity_type, extract = entry
+            extra = extract(entity) if extract else {}
+            api_entities.append(MessageEntity(
+                type=entity_type,
+                offset=entity.offset,
+                length=entity.length,
+                **extra
+            ))
                 
         return api_entities
 
@@ -93,30 +104,23 @@ class Normalizer:
             return "sticker"
             
         # Check by MIME type if it looks like a sticker but message.sticker was False (happens sometimes)
-        if message.document:
-            mime_type = message.document.mime_type
-            if mime_type == "image/webp" or mime_type == "application/x-tgsticker" or mime_type == "video/webm":
-                # It might be a sticker
-                # Additional check: attribute?
-                # But if it's webp, usually we want to treat it as sticker or photo?
-                # For safety, if it's specifically webp/tgsticker, we try sticker.
-                return "sticker"
+        document = message.document
+        if document and document.mime_type in _STICKER_MIMES:
+            return "sticker"
 
         if message.photo:
             return "photo"
-        if message.video:
-            # Check if it's an animation (gif) or round video
-            if message.video.attributes:
-                for attr in message.video.attributes:
-                    if isinstance(attr, types.DocumentAttributeAnimated):
-                        return "animation"
-                    # Round video note not explicitly requested but falls under video/voice sometimes depending on client
+        video = message.video
+        if video:
+            # Animations (gifs) are videos with the animated attribute
+            if any(type(attr) is _ANIMATED for attr in video.attributes or ()):
+                return "animation"
             return "video"
         if message.voice:
             return "voice"
         if message.audio:
             return "audio"
-        if message.document:
+        if document:
             return "document"
         return None
 
@@ -149,8 +153,7 @@ class Normalizer:
         msg.entities = cls.map_entities(message.entities, msg.text)
         
         # 1. Calculate current length in UTF-16 code units (for Telegram offsets)
-        # Python strings are weird, but encoding to utf-16-le gives 2 bytes per unit.
-        current_len_utf16 = len(msg.text.encode('utf-16-le')) // 2
+        current_len_utf16 = cls.utf16_len(msg.text)
         
         # 2. Append footer
         footer_text = "\n\n@mirrors_sliv"
@@ -182,11 +185,7 @@ class Normalizer:
             offset = 0
             length = 12
 
-        msg.entities.append({
-            "type": "mention",
-            "offset": offset,
-            "length": length
-        })
+        msg.entities.append(_footer_entity(offset, length))
         
         msg.media_type = cls.determine_media_type(message)
         
@@ -3,7 +3,7 @@ import logging
 import os
 from typing import List, Union, Optional
 from aiogram import Bot, exceptions
-from aiogram.types import FSInputFile, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+from aiogram.types import BufferedInputFile, FSInputFile, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio, ReplyParameters
 from aiogram.utils.token import TokenValidationError
 
 from src.normalizer import UnifiedMessage
@@ -20,24 +20,36 @@ class BotSender:
             self.bot = None
 
     async def _handle_flood_wait(self, e: exceptions.TelegramRetryAfter):
-        logger.warning(f"FloodWait: sleeping {e.retry_after}s")
+        logger.warning("FloodWait: sleeping %ss", e.retry_after)
         await asyncio.sleep(e.retry_after)
 
+    @staticmethod
+    def _input_file(message: UnifiedMessage) -> Optional[Union[BufferedInputFile, FSInputFile]]:
+        if message.media_bytes is not None:
+            return BufferedInputFile(message.media_bytes, filename=message.media_name)
+        if message.media_path:
+            return FSInputFile(message.media_path)
+        return None
+
+    async def _send_with_retry(self, send, **kwargs):
+        """Calls `send`, sleeping out FloodWaits; the prepared arguments are reused on every attempt."""
+        retries = 0
+        while True:
+            try:
+                return await send(**kwargs)
+            except exceptions.TelegramRetryAfter as e:
+                if retries >= Config.FLOOD_WAIT_MAX_RETRIES:
+                    raise
+                retries += 1
+                await self._handle_flood_wait(e)
+
     async def send_message(self, target_chat_id: int, message: UnifiedMessage, topic_id: int = None, reply_to_message_id: int = None) -> Optional[int]:
         if not self.bot:
             return None
 
         try:
-            # Prepare entities logic: aiogram expects list of MessageEntity objects or None
-            # But the send methods usually take `entities` as a list of types.MessageEntity.
-            # Since we converted to dicts in Normalizer, we might need to rely on aiogram's adaptability 
-            # or reconstruct objects. Ideally, we just pass parameters compatible with api.
-            
-            # Actually, aiogram `bot.send_message` expects `entities` as `List[MessageEntity]`.
-            # Let's import MessageEntity and reconstruct.
-            from aiogram.types import MessageEntity, ReplyParameters
-            
-            entities = [MessageEntity(**e) for e in message.entities] if message.entities else None
+            # Normalizer already built aiogram MessageEntity objects
+            entities = message.entities or None
             
             # Common args
             kwargs = {
@@ -46,42 +58,40 @@ class BotSender:
                 "reply_parameters": ReplyParameters(message_id=reply_to_message_id) if reply_to_message_id else None
             }
 
-            sent_msg = None
-            if message.media_path:
-                media_file = FSInputFile(message.media_path)
+            media_file = self._input_file(message)
+            if media_file:
+                caption = {"caption": message.text, "caption_entities": entities}
                 
                 if message.media_type == "photo":
-                    sent_msg = await self.bot.send_photo(photo=media_file, caption=message.text, caption_entities=entities, **kwargs)
+                    send, kwargs = self.bot.send_photo, {"photo": media_file, **caption, **kwargs}
                 elif message.media_type == "video":
-                    sent_msg = await self.bot.send_video(video=media_file, caption=message.text, caption_entities=entities, supports_streaming=True, **kwargs)
+                    send, kwargs = self.bot.send_video, {"video": media_file, **caption, "supports_streaming": True, **kwargs}
                 elif message.media_type == "document":
-                    sent_msg = await self.bot.send_document(document=media_file, caption=message.text, caption_entities=entities, **kwargs)
+                    send, kwargs = self.bot.send_document, {"document": media_file, **caption, **kwargs}
                 elif message.media_type == "voice":
-                    sent_msg = await self.bot.send_voice(voice=media_file, caption=message.text, caption_entities=entities, **kwargs)
+                    send, kwargs = self.bot.send_voice, {"voice": media_file, **caption, **kwargs}
                 elif message.media_type == "audio":
-                    sent_msg = await self.bot.send_audio(audio=media_file, caption=message.text, caption_entities=entities, **kwargs)
+                    send, kwargs = self.bot.send_audio, {"audio": media_file, **caption, **kwargs}
                 elif message.media_type == "animation":
-                    sent_msg = await self.bot.send_animation(animation=media_file, caption=message.text, caption_entities=entities, **kwargs)
+                    send, kwargs = self.bot.send_animation, {"animation": media_file, **caption, **kwargs}
                 elif message.media_type == "sticker":
-                    sent_msg = await self.bot.send_sticker(sticker=media_file, **kwargs)
+                    send, kwargs = self.bot.send_sticker, {"sticker": media_file, **kwargs}
                 else:
                     # Fallback or unknown
-                    logger.warning(f"Unknown media type {message.media_type}, sending as document")
-                    sent_msg = await self.bot.send_document(document=media_file, caption=message.text, caption_entities=entities, **kwargs)
+                    logger.warning("Unknown media type %s, sending as document", message.media_type)
+                    send, kwargs = self.bot.send_document, {"document": media_file, **caption, **kwargs}
             else:
                 # Text only
-                if message.text:
-                    sent_msg = await self.bot.send_message(text=message.text, entities=entities, **kwargs)
-                else:
-                    logger.debug(f"Skipping empty message {message.source_message_id}")
+                if not message.text:
+                    logger.debug("Skipping empty message %s", message.source_message_id)
+                    return None
+                send, kwargs = self.bot.send_message, {"text": message.text, "entities": entities, **kwargs}
 
+            sent_msg = await self._send_with_retry(send, **kwargs)
             return sent_msg.message_id if sent_msg else None
 
-        except exceptions.TelegramRetryAfter as e:
-            await self._handle_flood_wait(e)
-            return await self.send_message(target_chat_id, message, topic_id, reply_to_message_id) # Retry
         except Exception as e:
-            logger.error(f"Failed to send message to {target_chat_id}: {e}", exc_info=True)
+            logger.error("Failed to send message to %s: %s", target_chat_id, e, exc_info=True)
             return None
 
     async def send_album(self, target_chat_id: int, messages: List[UnifiedMessage], topic_id: int = None, reply_to_message_id: int = None) -> List[int]:
@@ -95,14 +105,13 @@ class BotSender:
             # We will attach captions to respective items.
             
             media_group = []
-            from aiogram.types import MessageEntity, ReplyParameters
             
             for msg in messages:
-                if not msg.media_path:
+                file = self._input_file(msg)
+                if not file:
                     continue
                     
-                file = FSInputFile(msg.media_path)
-                entities = [MessageEntity(**e) for e in msg.entities] if msg.entities else None
+                entities = msg.entities or None
                 
                 if msg.media_type == "photo":
                     media_group.append(InputMediaPhoto(media=file, caption=msg.text, caption_entities=entities))
@@ -117,7 +126,8 @@ class BotSender:
             if not media_group:
                 return []
 
-            sent_messages = await self.bot.send_media_group(
+            sent_messages = await self._send_with_retry(
+                self.bot.send_media_group,
                 chat_id=target_chat_id, 
                 media=media_group, 
                 message_thread_id=topic_id,
@@ -125,9 +135,6 @@ class BotSender:
             )
             return [m.message_id for m in sent_messages]
             
-        except exceptions.TelegramRetryAfter as e:
-            await self._handle_flood_wait(e)
-            return await self.send_album(target_chat_id, messages, topic_id, reply_to_message_id)
         except Exception as e:
-            logger.error(f"Failed to send album to {target_chat_id}: {e}", exc_info=True)
+            logger.error("Failed to send album to %s: %s", target_chat_id, e, exc_info=True)
             return []
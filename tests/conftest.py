@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# Imported once here so Telethon, aiogram and SQLAlchemy load during collection,
+# not inside whichever test touches them first
+import src.listener
+import src.normalizer
+import src.sender
+from src.database import Base, Deduper
+
+class MockDB:
+    """Stands in for Database, handing out sessions bound to the test's connection."""
+    def __init__(self, session_maker, connection):
+        self.session_maker = session_maker
+        self.connection = connection
+
+    def session(self):
+        return self.session_maker(bind=self.connection)
+
+def pytest_asyncio_loop_factories(config, item):
+    # Same loop as production: uvloop where available, the stdlib loop otherwise
+    try:
+        import uvloop
+    except ImportError:
+        return {"asyncio": asyncio.new_event_loop}
+    return {"uvloop": uvloop.new_event_loop}
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def engine():
+    # One in-memory database and schema for the whole run, on a single reused connection
+    engine = create_async_engine(
+        "sqlite+aiosqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False
+    )
+
+    # pysqlite's own transaction handling swallows SAVEPOINTs; let SQLAlchemy emit BEGIN itself
+    @event.listens_for(engine.sync_engine, "connect")
+    def _disable_driver_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+@pytest.fixture(scope="session")
+def session_maker():
+    # Built once; each test binds its sessions to its own connection
+    return async_sessionmaker(expire_on_commit=False, join_transaction_mode="create_savepoint")
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def db(engine, session_maker):
+    # Everything a test commits only releases a SAVEPOINT; the outer transaction is rolled back
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        yield MockDB(session_maker, connection)
+        await transaction.rollback()
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def deduper(db):
+    return Deduper(db)
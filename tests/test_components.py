@@ -1,182 +1,286 @@
-import unittest
 import asyncio
+import pytest
+from contextlib import nullcontext
 from unittest.mock import MagicMock, AsyncMock, patch
 from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace as NS
+
+from aiogram.types import MessageEntity
 
 from src.normalizer import Normalizer, UnifiedMessage
-from src.database import Deduper
 from src.listener import Listener
+from src.sender import BotSender
 from src.config import Route, Config
 
-class TestNormalizer(unittest.TestCase):
-    def test_text_normalization(self):
-        msg = MagicMock()
-        msg.id = 1
-        msg.chat_id = 100
-        msg.date = datetime.now()
-        msg.grouped_id = None
-        msg.message = "Hello World"
-        msg.entities = []
-        msg.reply_to = None  # Explicitly set to None
-        msg.photo = None
-        msg.video = None
-        msg.voice = None
-        msg.audio = None
-        msg.document = None
-        msg.sticker = None
-
-        unified = asyncio.run(Normalizer.normalize(msg))
-        self.assertEqual(unified.text, "Hello World\n\n@mirrors_sliv")
-        self.assertEqual(unified.source_chat_id, 100)
-        self.assertIsNone(unified.source_topic_id)
-        
-    def test_topic_id_extraction(self):
-        msg = MagicMock()
-        msg.id = 5
-        msg.chat_id = 200
-        msg.date = datetime.now()
-        msg.grouped_id = None
-        msg.message = "Topic Msg"
-        msg.entities = []
-        msg.photo = None
-        # ... 
-        
-        # Test with reply_to_top_id
-        msg.reply_to.reply_to_top_id = 123
-        msg.reply_to.forum_topic = True
-        
-        unified = asyncio.run(Normalizer.normalize(msg))
-        self.assertEqual(unified.source_topic_id, 123)
-        
-        # Test fallback to reply_to_msg_id if top_id is missing but forum_topic is set?
-        # Based on logic:
-        # if not topic_id and getattr(message.reply_to, 'forum_topic', False):
-        #    topic_id = getattr(message.reply_to, 'reply_to_msg_id', None)
-        
-        msg2 = MagicMock()
-        msg2.id = 6
-        msg2.chat_id = 200
-        msg2.date = datetime.now()
-        msg2.grouped_id = None
-        msg2.message = "Fallback"
-        msg2.entities = []
-        msg2.photo = None
-        msg2.reply_to.reply_to_top_id = None
-        msg2.reply_to.forum_topic = True
-        msg2.reply_to.reply_to_msg_id = 456
-        
-        unified2 = asyncio.run(Normalizer.normalize(msg2))
-        self.assertEqual(unified2.source_topic_id, 456)
-        
-    def test_media_type_detection(self):
-        msg = MagicMock()
-        msg.id = 2
-        msg.chat_id = 100
-        msg.date = datetime.now()
-        msg.grouped_id = None
-        msg.message = ""
-        msg.entities = []
-        msg.photo = True
-        msg.video = None
-        msg.sticker = None
-        msg.document = None
-        msg.reply_to = None
-        # ... other attrs None
-
-        unified = asyncio.run(Normalizer.normalize(msg))
-        self.assertEqual(unified.media_type, "photo")
-
-    def test_reply_extraction(self):
-        msg = MagicMock()
-        msg.id = 10
-        msg.chat_id = 300
-        msg.date = datetime.now()
-        msg.grouped_id = None
-        msg.message = "Reply Msg"
-        msg.entities = []
-        msg.photo = None
-        
-        # Mock reply info
-        msg.reply_to.reply_to_msg_id = 777
-        msg.reply_to.reply_to_top_id = None
-        msg.reply_to.forum_topic = False
-        
-        unified = asyncio.run(Normalizer.normalize(msg))
-        self.assertEqual(unified.reply_to_msg_id, 777)
-
-class TestListenerFilters(unittest.TestCase):
-    def setUp(self):
-        self.deduper = AsyncMock(spec=Deduper)
-        self.queue = asyncio.Queue()
-        
-        # Patch TelegramClient
-        patcher = patch('src.listener.TelegramClient')
-        self.MockClient = patcher.start()
-        self.addCleanup(patcher.stop)
-        
-        # Setup mock client instance
-        self.mock_client_instance = self.MockClient.return_value
-        
-        self.listener = Listener(self.deduper, self.queue)
-
-    def test_time_filter(self):
-        # Old message
-        msg = MagicMock()
-        # Ensure UTC timezone awareness to match listener logic
-        msg.date = datetime.now(timezone.utc) - timedelta(minutes=10)
-        route = Route("test_route", 1, 2)
-        
-        self.assertFalse(self.listener._should_process(msg, route))
-        
-        # New message
-        msg.date = datetime.now(timezone.utc) - timedelta(minutes=1)
-        self.assertTrue(self.listener._should_process(msg, route))
-
-    def test_topic_filter(self):
-        route = Route("topic_route", 1, 2, source_topic_id=55)
-        
-        # Message in different topic
-        msg_wrong = MagicMock()
-        msg_wrong.date = datetime.now(timezone.utc)
-        msg_wrong.reply_to.reply_to_top_id = 99
-        self.assertFalse(self.listener._should_process(msg_wrong, route))
-
-        # Message in correct topic
-        msg_right = MagicMock()
-        msg_right.date = datetime.now(timezone.utc)
-        msg_right.reply_to.reply_to_top_id = 55
-        self.assertTrue(self.listener._should_process(msg_right, route))
-        
-        # Message with no reply info (assuming topic required)
-        msg_no_reply = MagicMock()
-        msg_no_reply.date = datetime.now(timezone.utc)
-        msg_no_reply.reply_to = None
-        self.assertFalse(self.listener._should_process(msg_no_reply, route))
-
-    def test_content_blacklist(self):
-        route = Route("test_route", 1, 2)
-        Config.BLACKLIST_WORDS = ["mirror", "миррор"]
-        
-        # Clean message
-        msg_ok = MagicMock()
-        msg_ok.date = datetime.now(timezone.utc)
-        msg_ok.message = "This is a fine message"
-        msg_ok.reply_to = None
-        self.assertTrue(self.listener._should_process(msg_ok, route))
-        
-        # Blacklisted message (English)
-        msg_bad = MagicMock()
-        msg_bad.date = datetime.now(timezone.utc)
-        msg_bad.message = "This contains a mirror word"
-        msg_bad.reply_to = None
-        self.assertFalse(self.listener._should_process(msg_bad, route))
-        
-        # Blacklisted message (Russian)
-        msg_bad_ru = MagicMock()
-        msg_bad_ru.date = datetime.now(timezone.utc)
-        msg_bad_ru.message = "Тут есть слово миррор"
-        msg_bad_ru.reply_to = None
-        self.assertFalse(self.listener._should_process(msg_bad_ru, route))
-
-if __name__ == '__main__':
-    unittest.main()
+# Listener tests pass this in as "now", so ages don't depend on when the test runs
+NOW_UTC = datetime.now(timezone.utc)
+
+ROUTE_BASIC = Route("test_route", 1, 2)
+ROUTE_TOPIC = Route("topic_route", 1, 2, source_topic_id=55)
+ROUTE_CATCH_ALL = Route("all_route", 1, 3)
+
+def _make_msg(normalizable=False, **kw):
+    """A Telethon message stand-in with what the listener filters read already set.
+
+    With normalizable=True it also has everything Normalizer.normalize reads, and no media.
+    """
+    attrs = dict(id=1, date=NOW_UTC, message="", grouped_id=None, reply_to_top_id=None, reply_to=None)
+    if normalizable:
+        attrs.update(chat_id=100, entities=[], photo=None, video=None, voice=None, audio=None, document=None, sticker=None)
+    attrs.update(kw)
+    return NS(**attrs)
+
+# Normalizer
+
+@pytest.mark.parametrize("attrs,field,expected", [
+    (dict(message="Hello World"), "text", "Hello World\n\n@mirrors_sliv"),
+    (dict(message="Hello World"), "source_chat_id", 100),
+    (dict(message="Hello World"), "source_topic_id", None),
+    (dict(reply_to=NS(reply_to_top_id=123, forum_topic=True)), "source_topic_id", 123),
+    # Forum replies without a top id fall back to reply_to_msg_id
+    (dict(reply_to=NS(reply_to_top_id=None, forum_topic=True, reply_to_msg_id=456)), "source_topic_id", 456),
+    (dict(photo=True), "media_type", "photo"),
+    (dict(reply_to=NS(reply_to_msg_id=777, reply_to_top_id=None, forum_topic=False)), "reply_to_msg_id", 777),
+])
+async def test_normalize(attrs, field, expected):
+    unified = await Normalizer.normalize(_make_msg(normalizable=True, **attrs))
+    assert getattr(unified, field) == expected
+
+def test_entity_mapping():
+    from telethon import types
+    entities = [
+        types.MessageEntityBold(offset=0, length=5),
+        types.MessageEntityTextUrl(offset=6, length=5, url="https://example.com"),
+        types.MessageEntityHashtag(offset=12, length=4),  # no Bot API mapping, dropped
+    ]
+    assert Normalizer.map_entities(entities, "Hello World #tag") == [
+        MessageEntity(type="bold", offset=0, length=5),
+        MessageEntity(type="text_link", offset=6, length=5, url="https://example.com"),
+    ]
+    
+def test_utf16_len():
+    for text in ["", "Hello", "Привет", "a😀b", "🎉🎉 𝕏"]:
+        assert Normalizer.utf16_len(text) == len(text.encode('utf-16-le')) // 2
+    
+def test_media_type_dispatch():
+    from telethon import types
+    msg = NS(sticker=None, photo=None, document=NS(mime_type="image/webp"), video=NS(attributes=None))
+    assert Normalizer.determine_media_type(msg) == "sticker"
+    
+    msg.document.mime_type = "video/mp4"
+    msg.video.attributes = [types.DocumentAttributeVideo(duration=1, w=1, h=1), types.DocumentAttributeAnimated()]
+    assert Normalizer.determine_media_type(msg) == "animation"
+    
+    msg.video.attributes = None
+    assert Normalizer.determine_media_type(msg) == "video"
+
+# Listener
+
+@pytest.fixture(scope="module")
+def telegram_client():
+    # Patched once for the module; every Listener gets the same mock
+    with patch('src.listener.TelegramClient') as client:
+        yield client
+
+class _StubDeduper:
+    """Deduper stand-in for listener tests: nothing is processed yet and every mark succeeds."""
+    def session(self):
+        return nullcontext()
+
+    async def is_processed(self, route, message_id, session=None):
+        return False
+
+    async def try_mark_processed(self, route, message_id, grouped_id=None, session=None):
+        return True
+
+    async def bulk_mark_processed(self, rows, session=None):
+        pass
+
+    async def bulk_filter_processed(self, route_names, source_chat_id, message_ids):
+        return set()
+
+@pytest.fixture
+def listener_deduper():
+    return _StubDeduper()
+
+@pytest.fixture
+def listener(telegram_client, listener_deduper):
+    return Listener(listener_deduper, [asyncio.Queue()])
+
+def test_time_filter(listener):
+    now = NOW_UTC.timestamp()
+    # Old message
+    msg = _make_msg(date=NOW_UTC - timedelta(minutes=10))
+    assert listener._is_too_old(msg, now)
+    
+    # New message
+    msg.date = NOW_UTC - timedelta(minutes=1)
+    assert not listener._is_too_old(msg, now)
+
+def test_topic_filter(listener):
+    listener._index_routes([ROUTE_TOPIC, ROUTE_CATCH_ALL])
+    
+    # Message in different topic
+    msg_wrong = _make_msg(reply_to=NS(reply_to_top_id=99))
+    assert listener._routes_for(1, msg_wrong) == (ROUTE_CATCH_ALL,)
+
+    # Message in correct topic
+    msg_right = _make_msg(reply_to=NS(reply_to_top_id=55))
+    assert listener._routes_for(1, msg_right) == (ROUTE_TOPIC, ROUTE_CATCH_ALL)
+    
+    # Message with no reply info only matches routes without a topic
+    msg_no_reply = _make_msg()
+    assert listener._routes_for(1, msg_no_reply) == (ROUTE_CATCH_ALL,)
+    
+    # Unknown chat
+    assert listener._routes_for(2, msg_right) == ()
+
+def test_content_blacklist(listener, monkeypatch):
+    # Both are patched so teardown restores the compiled regex along with the words
+    monkeypatch.setattr(Config, "BLACKLIST_WORDS", ("mirror", "миррор"))
+    monkeypatch.setattr(Config, "BLACKLIST_RE", None)
+    Config.compile_filters()
+    
+    # Clean message
+    assert not listener._is_blacklisted(_make_msg(message="This is a fine message"))
+    
+    # Blacklisted message (English)
+    assert listener._is_blacklisted(_make_msg(message="This contains a mirror word"))
+    
+    # Blacklisted message (Russian)
+    assert listener._is_blacklisted(_make_msg(message="Тут есть слово миррор"))
+    
+    # Matching is case-insensitive
+    assert listener._is_blacklisted(_make_msg(message="Fresh MIRROR drop"))
+
+async def test_chat_processor_drains_batch(listener):
+    listener._index_routes([ROUTE_BASIC])
+    listener._process_single_message = AsyncMock()
+
+    queue = asyncio.Queue()
+    # The processor checks age against the wall clock
+    date = datetime.now(timezone.utc)
+    for i in range(3):
+        queue.put_nowait((_make_msg(id=i, date=date), False))
+    # Evicted: the processor drains its queue and exits
+    listener._retiring.add(1)
+    queue.put_nowait(None)
+    await asyncio.wait_for(listener._chat_processor(1, queue), 1)
+    # Every dequeued item, sentinel included, is acknowledged
+    await asyncio.wait_for(queue.join(), 1)
+    
+    assert listener._process_single_message.await_count == 3
+
+async def test_poll_retries_batch_after_filter_error(listener, listener_deduper, monkeypatch):
+    listener._index_routes([ROUTE_BASIC])
+    history = [_make_msg(id=i) for i in (5, 6, 7)]
+
+    async def iter_messages(chat_id, min_id=0, reverse=False, limit=None):
+        for message in history:
+            if message.id > min_id:
+                yield message
+    listener.client.iter_messages = iter_messages
+    listener._enqueue = AsyncMock()
+
+    filter_processed = AsyncMock(side_effect=[RuntimeError("database is locked"), set()])
+    monkeypatch.setattr(listener_deduper, "bulk_filter_processed", filter_processed)
+
+    with pytest.raises(RuntimeError):
+        await listener._poll_one(1)
+    # Nothing was handed off, so nothing is marked as seen
+    assert listener.last_seen.get(1, 0) == 0
+
+    await listener._poll_one(1)
+    assert filter_processed.await_args.args[2] == [5, 6, 7]
+    assert [call.args[1][0].id for call in listener._enqueue.await_args_list] == [5, 6, 7]
+    assert listener.last_seen[1] == 7
+
+async def test_chat_eviction(listener, monkeypatch):
+    monkeypatch.setattr(Config, "MAX_ACTIVE_CHATS", 1)
+    listener._index_routes([ROUTE_BASIC, Route("other_route", 2, 3)])
+    handled = []
+
+    async def record(message, route):
+        handled.append((message.chat_id, message.id))
+        await asyncio.sleep(0)
+    listener._process_single_message = record
+
+    async def receive(chat_id, message_id):
+        await listener._handle_new_message(NS(message=_make_msg(id=message_id, chat_id=chat_id)))
+
+    async with asyncio.TaskGroup() as tg:
+        listener._task_group = tg
+        for i in range(3):
+            await receive(1, i)
+        # Evicts chat 1, which keeps its processor until the queue is drained
+        await receive(2, 0)
+        assert list(listener.chat_tasks) == [1, 2]
+        # Unrouted chats get no processor at all
+        await receive(3, 0)
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert list(listener.chat_tasks) == [2]
+
+        # The next message respawns chat 1, evicting chat 2 in turn
+        await receive(1, 3)
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert list(listener.chat_tasks) == [1]
+        for task in listener.chat_tasks.values():
+            task.cancel()
+
+    assert [m for c, m in handled if c == 1] == [0, 1, 2, 3]
+    assert [m for c, m in handled if c == 2] == [0]
+
+async def test_processor_crash_is_contained(listener):
+    listener._index_routes([ROUTE_BASIC])
+    listener._process_chat = AsyncMock(side_effect=RuntimeError("boom"))
+
+    # The group exits normally: the crash neither propagates nor leaves the chat registered
+    async with asyncio.TaskGroup() as tg:
+        listener._task_group = tg
+        await listener._handle_new_message(NS(message=_make_msg(chat_id=1)))
+    assert not listener.chat_tasks
+
+    # Messages arriving after the listener stopped are dropped
+    listener._task_group = None
+    await listener._handle_new_message(NS(message=_make_msg(chat_id=1)))
+    assert not listener.chat_tasks
+
+# Sender
+
+@pytest.fixture
+def sender():
+    sender = BotSender.__new__(BotSender)
+    sender.bot = MagicMock()
+    sender._handle_flood_wait = AsyncMock()
+    return sender
+
+def _flood():
+    from aiogram import exceptions
+    from aiogram.methods import SendMessage
+    return exceptions.TelegramRetryAfter(method=SendMessage(chat_id=1, text="x"), message="flood", retry_after=0)
+
+async def test_flood_wait_retry(sender):
+    sender.bot.send_message = AsyncMock(side_effect=[_flood(), _flood(), MagicMock(message_id=42)])
+    msg = UnifiedMessage(text="Hello")
+    
+    assert await sender.send_message(1, msg) == 42
+    assert sender.bot.send_message.await_count == 3
+
+async def test_in_memory_media(sender):
+    from aiogram.types import BufferedInputFile
+    sender.bot.send_photo = AsyncMock(return_value=MagicMock(message_id=7))
+    msg = UnifiedMessage(text="Pic", media_type="photo", media_bytes=b"data", media_name="1.jpg")
+    
+    assert await sender.send_message(1, msg) == 7
+    photo = sender.bot.send_photo.await_args.kwargs["photo"]
+    assert isinstance(photo, BufferedInputFile)
+    assert photo.filename == "1.jpg"
+
+async def test_flood_wait_gives_up(sender):
+    sender.bot.send_message = AsyncMock(side_effect=_flood())
+    msg = UnifiedMessage(text="Hello")
+    
+    assert await sender.send_message(1, msg) is None
+    assert sender.bot.send_message.await_count == Config.FLOOD_WAIT_MAX_RETRIES + 1
@@ -1,103 +1,194 @@
-import unittest
-import asyncio
-import os
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
-
-from src.database import Base, Deduper, ProcessedMessage
-from src.config import Route
-
-class TestDatabase(unittest.TestCase):
-    async def asyncSetUp(self):
-        # Use in-memory SQLite for testing
-        self.engine = create_async_engine("sqlite+aiosqlite:///:memory:", echo=False)
-        
-        # Create tables
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-            
-        self.async_session = async_sessionmaker(self.engine, expire_on_commit=False)
-        
-        # Mock Database class to return our session
-        class MockDB:
-            def __init__(self, session_maker):
-                self.session_maker = session_maker
-            async def get_session(self):
-                return self.session_maker()
-                
-        self.db = MockDB(self.async_session)
-        self.deduper = Deduper(self.db)
-
-    def setUp(self):
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.asyncSetUp())
-
-    def tearDown(self):
-        self.loop.close()
-
-    def test_deduplication(self):
-        async def run_test():
-            route1 = Route("route1", 100, 200)
-            route2 = Route("route2", 101, 200)
-            
-            # 1. Check not exists
-            exists = await self.deduper.is_processed(route1, 1)
-            self.assertFalse(exists)
-            
-            # 2. Add
-            await self.deduper.add_processed(route1, 1)
-            
-            # 3. Check exists
-            exists = await self.deduper.is_processed(route1, 1)
-            self.assertTrue(exists)
-            
-            # 4. Check other message not exists
-            exists = await self.deduper.is_processed(route1, 2)
-            self.assertFalse(exists)
-            
-            # 5. Check distinct route
-            exists = await self.deduper.is_processed(route2, 1)
-            self.assertFalse(exists)
-            
-        self.loop.run_until_complete(run_test())
-
-    def test_duplicate_constraint(self):
-        async def run_test():
-            route = Route("route_dupe", 100, 200)
-            await self.deduper.add_processed(route, 5)
-            
-            # Try add again - should fail or be handled silently if logic changed, 
-            # but here we expect unique constraint exception if not caught,
-            # OR our code catches it. In src/database.py we catch and raise.
-            
-            from sqlalchemy.exc import IntegrityError
-            
-            with self.assertRaises(IntegrityError):
-                 await self.deduper.add_processed(route, 5)
-                 
-        self.loop.run_until_complete(run_test())
-
-    def test_target_message_mapping(self):
-        async def run_test():
-            route = Route("mapping_test", 300, 400)
-            source_id = 123
-            target_id = 999
-            
-            # Add message
-            await self.deduper.add_processed(route, source_id)
-            
-            # Check target id is None
-            tid = await self.deduper.get_target_message_id(route.name, route.source_id, source_id)
-            self.assertIsNone(tid)
-            
-            # Update target id
-            await self.deduper.update_target_message_id(route.name, route.source_id, source_id, target_id)
-            
-            # Check target id
-            tid = await self.deduper.get_target_message_id(route.name, route.source_id, source_id)
-            self.assertEqual(tid, target_id)
-            
-        self.loop.run_until_complete(run_test())
-
-if __name__ == '__main__':
-    unittest.main()
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from src.database import Database, Deduper, ProcessedMessage
+from src.dedupe_cache import DeduplicationCache
+from src.config import Config, Route
+
+# Each test rolls back its rows, so they can all share these
+ROUTE_DEDUP_1 = Route("route1", 100, 200)
+ROUTE_DEDUP_2 = Route("route2", 101, 200)
+ROUTE_SAME_SOURCE = Route("route3", 100, 201)
+ROUTE_OTHER = Route("route_other", 100, 202)
+
+async def test_deduplication(deduper):
+    # 1. Check not exists
+    assert not await deduper.is_processed(ROUTE_DEDUP_1, 1)
+    
+    # 2. Add
+    await deduper.add_processed(ROUTE_DEDUP_1, 1)
+    
+    # 3. Check exists
+    assert await deduper.is_processed(ROUTE_DEDUP_1, 1)
+    
+    # 4. Check other message not exists
+    assert not await deduper.is_processed(ROUTE_DEDUP_1, 2)
+    
+    # 5. Check distinct route
+    assert not await deduper.is_processed(ROUTE_DEDUP_2, 1)
+
+async def test_duplicate_constraint(db):
+    # Both rows go out in one flush; the composite primary key rejects the second
+    rows = [ProcessedMessage(route_name="route_dupe", source_chat_id=100, source_message_id=5) for _ in range(2)]
+    async with db.session() as session:
+        session.add_all(rows)
+        with pytest.raises(IntegrityError):
+            await session.commit()
+
+async def test_try_mark_processed(deduper):
+    # First call inserts, second one is ignored
+    assert await deduper.try_mark_processed(ROUTE_DEDUP_1, 7)
+    assert not await deduper.try_mark_processed(ROUTE_DEDUP_1, 7)
+    assert await deduper.is_processed(ROUTE_DEDUP_1, 7)
+
+async def test_bulk_mark_processed(deduper):
+    await deduper.add_processed(ROUTE_DEDUP_1, 11)
+    
+    rows = [
+        {"route_name": ROUTE_DEDUP_1.name, "source_chat_id": ROUTE_DEDUP_1.source_id, "source_message_id": mid, "grouped_id": 42}
+        for mid in (10, 11, 12)
+    ]
+    # Already processed rows are skipped, not raised on
+    await deduper.bulk_mark_processed(rows)
+    
+    for mid in (10, 11, 12):
+        assert await deduper.is_processed(ROUTE_DEDUP_1, mid)
+
+async def test_bulk_filter_processed(deduper):
+    await deduper.add_processed(ROUTE_DEDUP_1, 1)
+    await deduper.add_processed(ROUTE_SAME_SOURCE, 2)
+    await deduper.add_processed(ROUTE_OTHER, 3)
+    
+    processed = await deduper.bulk_filter_processed([ROUTE_DEDUP_1.name, ROUTE_SAME_SOURCE.name], 100, [1, 2, 3, 4])
+    assert processed == {(ROUTE_DEDUP_1.name, 1), (ROUTE_SAME_SOURCE.name, 2)}
+
+async def test_high_water_mark(deduper):
+    await deduper.add_processed(ROUTE_DEDUP_1, 5)
+    await deduper.load_high_water()
+    
+    # Ids above the mark are new without a DB lookup; below it the DB still decides
+    assert not await deduper.is_processed(ROUTE_DEDUP_1, 6)
+    assert not await deduper.is_processed(ROUTE_DEDUP_1, 4)
+    assert await deduper.is_processed(ROUTE_DEDUP_1, 5)
+    
+    # New inserts raise the mark
+    assert await deduper.try_mark_processed(ROUTE_DEDUP_1, 9)
+    deduper.cache = DeduplicationCache()
+    assert await deduper.is_processed(ROUTE_DEDUP_1, 9)
+    assert await deduper.bulk_filter_processed([ROUTE_DEDUP_1.name], 100, [5, 9, 10]) == {(ROUTE_DEDUP_1.name, 5), (ROUTE_DEDUP_1.name, 9)}
+    
+    # Routes without any rows yet have nothing processed
+    assert not await deduper.is_processed(ROUTE_SAME_SOURCE, 1)
+
+async def test_target_message_mapping(deduper):
+    source_id = 123
+    target_id = 999
+    
+    # Add message
+    await deduper.add_processed(ROUTE_DEDUP_1, source_id)
+    
+    # Check target id is None
+    assert await deduper.get_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, source_id) is None
+    
+    # Update target id
+    await deduper.update_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, source_id, target_id)
+    
+    # Check target id
+    assert await deduper.get_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, source_id) == target_id
+
+async def test_batched_target_writes(db, deduper):
+    for mid in (1, 2, 3):
+        await deduper.add_processed(ROUTE_DEDUP_1, mid)
+    
+    deduper.start()
+    for mid in (1, 2, 3):
+        await deduper.update_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, mid, mid + 100)
+    await deduper.update_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, 3, 303)
+    
+    # Pending writes are visible before they reach the DB
+    deduper.cache = DeduplicationCache()
+    assert await deduper.get_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, 3) == 303
+    
+    await deduper.stop()
+    fresh = Deduper(db)
+    for mid, target in ((1, 101), (2, 102), (3, 303)):
+        assert await fresh.get_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, mid) == target
+
+async def test_failed_target_writes_are_dropped(deduper, monkeypatch):
+    monkeypatch.setattr(Config, "DB_WRITE_MAX_RETRIES", 1)
+    attempts = []
+
+    def broken_session():
+        attempts.append(1)
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(deduper.db, "session", broken_session)
+
+    deduper.start()
+    await deduper.update_target_message_id(ROUTE_DEDUP_1.name, ROUTE_DEDUP_1.source_id, 1, 101)
+    # One retry, then the key is given up on instead of staying pending forever
+    await deduper.stop()
+    assert len(attempts) == 2
+    assert not deduper._pending_targets
+
+@pytest.mark.parametrize("interrupted", [False, True])
+async def test_migrate_old_schema(tmp_path, monkeypatch, interrupted):
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript("""
+            CREATE TABLE processed_messages (
+                id INTEGER PRIMARY KEY, route_name VARCHAR, source_chat_id INTEGER,
+                source_message_id INTEGER, grouped_id INTEGER, created_at DATETIME
+            );
+            CREATE UNIQUE INDEX idx_unique_message ON processed_messages (route_name, source_chat_id, source_message_id);
+            INSERT INTO processed_messages (route_name, source_chat_id, source_message_id) VALUES ('route1', 100, 1), ('route1', 100, 2);
+        """)
+        if interrupted:
+            # What an older, non-atomic rebuild left behind when it failed after the rename
+            conn.execute("ALTER TABLE processed_messages RENAME TO processed_messages_old")
+    conn.close()
+
+    monkeypatch.setattr(Config, "DB_NAME", str(path))
+    database = Database()
+    try:
+        await database.init_db()
+        async with database.engine.connect() as conn:
+            tables = (await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))).scalars().all()
+            rows = (await conn.execute(text(
+                "SELECT source_message_id, target_message_id FROM processed_messages ORDER BY source_message_id"
+            ))).all()
+    finally:
+        await database.engine.dispose()
+
+    assert tables == ["processed_messages"]
+    assert [tuple(row) for row in rows] == [(1, None), (2, None)]
+
+# DeduplicationCache
+
+def test_cache_lru_eviction():
+    cache = DeduplicationCache(max_size=2)
+    cache.add(("r", 1, 1))
+    cache.add(("r", 1, 2))
+    
+    # Touch the oldest key so the other one is evicted
+    assert cache.is_duplicate(("r", 1, 1))
+    cache.add(("r", 1, 3))
+    
+    assert cache.is_duplicate(("r", 1, 1))
+    assert not cache.is_duplicate(("r", 1, 2))
+    assert len(cache) == 2
+
+def test_cache_ttl_expiry():
+    cache = DeduplicationCache(ttl=-1)
+    cache.add(("r", 1, 1), 10)
+    assert not cache.is_duplicate(("r", 1, 1))
+    assert len(cache) == 0
+
+def test_cache_target_is_kept():
+    cache = DeduplicationCache()
+    cache.add(("r", 1, 1), 10)
+    cache.add(("r", 1, 1))
+    assert cache.get_target(("r", 1, 1)) == 10
+    assert cache.get_target(("r", 1, 2)) is None